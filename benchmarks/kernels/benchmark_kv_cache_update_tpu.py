@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: Apache-2.0
+# SPDX-FileCopyrightText: Copyright contributors to the vLLM project
+"""Benchmark the KV cache write of the TPU attention backend, with the
+kv_cache_update Pallas kernel against the default index_copy_ scatter, for
+prefill- and decode-sized token counts."""
+
+import functools
+import time
+
+import torch
+import torch_xla
+import torch_xla.core.xla_model as xm
+
+from vllm.utils import FlexibleArgumentParser
+from vllm.v1.attention.backends.pallas import write_to_kv_cache
+
+_PAD_SLOT_ID = 1_000_000_000
+
+
+@torch.no_grad()
+def benchmark(
+    use_kv_cache_update_kernel: bool,
+    num_tokens: int,
+    num_kv_heads: int,
+    head_size: int,
+    num_blocks: int,
+    block_size: int,
+    dtype: torch.dtype,
+    num_warmup_iters: int,
+    num_iters: int,
+) -> float:
+    device = torch_xla.device()
+    num_slots = num_blocks * block_size
+    key = torch.randn(num_tokens, num_kv_heads, head_size).to(dtype).to(device)
+    value = torch.randn(num_tokens, num_kv_heads, head_size).to(dtype).to(device)
+    kv_cache = torch.zeros(
+        num_blocks, block_size, num_kv_heads * 2, head_size, dtype=dtype
+    ).to(device)
+    slot_mapping = torch.randperm(num_slots)[:num_tokens]
+    # Mimic the padding of the TPU model runner.
+    slot_mapping[-1] = _PAD_SLOT_ID
+    slot_mapping = slot_mapping.to(device)
+    # The same in-place write, with buffer donation, as the attention backend.
+    compiled_fn = torch.compile(
+        functools.partial(
+            write_to_kv_cache, use_kv_cache_update_kernel=use_kv_cache_update_kernel
+        ),
+        backend="openxla",
+        fullgraph=True,
+        dynamic=False,
+    )
+
+    def run(num_iters: int) -> float:
+        xm.wait_device_ops()
+        start_time = time.perf_counter()
+        for _ in range(num_iters):
+            compiled_fn(key, value, kv_cache, slot_mapping)
+        xm.mark_step()
+        xm.wait_device_ops()
+        return (time.perf_counter() - start_time) / num_iters
+
+    run(num_warmup_iters)
+    return run(num_iters)
+
+
+def main(args) -> None:
+    dtype = getattr(torch, args.dtype)
+    print(f"{'num_tokens':>10} {'index_copy_ (us)':>18} {'pallas (us)':>14}")
+    for num_tokens in args.num_tokens:
+        latencies = [
+            benchmark(
+                use_kv_cache_update_kernel,
+                num_tokens,
+                args.num_kv_heads,
+                args.head_size,
+                args.num_blocks,
+                args.block_size,
+                dtype,
+                args.num_warmup_iters,
+                args.num_iters,
+            )
+            for use_kv_cache_update_kernel in (False, True)
+        ]
+        print(
+            f"{num_tokens:>10} {latencies[0] * 1e6:>18.2f} {latencies[1] * 1e6:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = FlexibleArgumentParser(description="Benchmark the TPU KV cache write.")
+    parser.add_argument(
+        "--num-tokens",
+        type=int,
+        nargs="+",
+        # Decode-sized and prefill-sized batches.
+        default=[16, 64, 256, 1024, 8192],
+    )
+    parser.add_argument("--num-kv-heads", type=int, default=8)
+    parser.add_argument("--head-size", type=int, default=128)
+    parser.add_argument("--num-blocks", type=int, default=4096)
+    parser.add_argument("--block-size", type=int, default=32)
+    parser.add_argument(
+        "--dtype", type=str, choices=["bfloat16", "float8_e4m3fn"], default="bfloat16"
+    )
+    parser.add_argument("--num-warmup-iters", type=int, default=5)
+    parser.add_argument("--num-iters", type=int, default=100)
+    main(parser.parse_args())
@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: Apache-2.0
+# SPDX-FileCopyrightText: Copyright contributors to the vLLM project
+
+import pytest
+import torch
+import torch_xla
+
+import vllm.v1.attention.backends.pallas  # noqa: F401
+from vllm.platforms import current_platform
+
+
+@pytest.mark.skipif(not current_platform.is_tpu(),
+                    reason="This is a test for TPU only")
+@pytest.mark.parametrize("num_tokens", [16, 37])
+@pytest.mark.parametrize("num_kv_heads", [1, 8])
+@pytest.mark.parametrize("head_size", [128, 256])
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float8_e4m3fn])
+def test_kv_cache_update(num_tokens: int, num_kv_heads: int, head_size: int,
+                         dtype: torch.dtype):
+    torch.manual_seed(0)
+    device = torch_xla.device()
+    num_blocks = 64
+    block_size = 16
+    num_slots = num_blocks * block_size
+    num_pad_tokens = 3
+
+    key = torch.randn(num_tokens, num_kv_heads, head_size).to(dtype)
+    value = torch.randn(num_tokens, num_kv_heads, head_size).to(dtype)
+    kv_cache = torch.zeros(num_blocks,
+                           block_size,
+                           num_kv_heads * 2,
+                           head_size,
+                           dtype=dtype)
+    slot_mapping = torch.randperm(num_slots)[:num_tokens]
+    # Padded tokens use an out-of-range slot id and must be ignored.
+    slot_mapping[-num_pad_tokens:] = 1_000_000_000
+
+    new_kv_cache = torch.ops.xla.kv_cache_update(key.to(device),
+                                                 value.to(device),
+                                                 slot_mapping.to(device),
+                                                 kv_cache.to(device))
+
+    # The reference is computed in float32, since assert_close does not
+    # support float8. The dtype round trip is exact.
+    valid = slice(0, num_tokens - num_pad_tokens)
+    ref_kv = torch.stack(
+        [key[valid].to(torch.float32), value[valid].to(torch.float32)],
+        dim=2).reshape(-1, num_kv_heads * 2, head_size)
+    ref_kv_cache = kv_cache.to(torch.float32).flatten(0, 1).index_copy(
+        0, slot_mapping[valid], ref_kv).view(kv_cache.shape)
+    torch.testing.assert_close(new_kv_cache.cpu().to(torch.float32),
+                               ref_kv_cache)
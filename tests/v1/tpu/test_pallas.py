@@ -1,19 +1,89 @@
 # SPDX-License-Identifier: Apache-2.0
 # SPDX-FileCopyrightText: Copyright contributors to the vLLM project
-from unittest.mock import ANY, patch
+from typing import Optional
+from unittest.mock import ANY, MagicMock, patch
 
+import pytest
 import torch
 
 from vllm.attention.backends.abstract import AttentionType
-from vllm.v1.attention.backends.pallas import (PallasAttentionBackendImpl,
-                                               PallasMetadata)
+from vllm.v1.attention.backends.pallas import (
+    PallasAttentionBackend, PallasAttentionBackendImpl, PallasMetadata,
+    _ragged_paged_attention_supports_kv_scales)
 
 
-def test_ragged_paged_attention():
+class FakeAttentionLayer:
+    _k_scale_float: float
+    _v_scale_float: float
+
+
+def make_attn_metadata(num_tokens: int) -> PallasMetadata:
+    slot_mapping = torch.arange(num_tokens, dtype=torch.int64)
+    max_num_reqs = 8
+    max_num_blocks_per_req = 8
+    block_tables = torch.zeros((max_num_reqs, max_num_blocks_per_req),
+                               dtype=torch.int32)
+    context_lens = torch.ones((max_num_reqs, ), dtype=torch.int32)
+    query_lens = [1] * max_num_reqs
+    query_start_loc = torch.cumsum(torch.tensor([0] + query_lens,
+                                                dtype=torch.int32),
+                                   dim=0,
+                                   dtype=torch.int32)
+    num_seqs = torch.tensor([max_num_reqs], dtype=torch.int32)
+    return PallasMetadata(
+        slot_mapping=slot_mapping,
+        block_tables=block_tables,
+        context_lens=context_lens,
+        query_start_loc=query_start_loc,
+        num_seqs=num_seqs,
+    )
+
+
+def assert_kv_cache_written(kv_cache: torch.Tensor, key: torch.Tensor,
+                            value: torch.Tensor, slot_mapping: torch.Tensor):
+    # The combined kv heads are interleaved as [k0, v0, k1, v1, ...]. Compared
+    # in float32, as assert_close does not support float8.
+    _, _, num_combined_kv_heads, head_size = kv_cache.shape
+    expected = torch.stack([key, value], dim=2).reshape(
+        -1, num_combined_kv_heads, head_size)
+    torch.testing.assert_close(
+        kv_cache.flatten(0, 1)[slot_mapping].to(torch.float32),
+        expected.to(torch.float32))
+
+
+@pytest.mark.parametrize("kv_cache_dtype", ["auto", "fp8"])
+@pytest.mark.parametrize("use_kv_cache_update_kernel", [False, True])
+@pytest.mark.parametrize(
+    "num_kv_pages_per_block,num_queries_per_block,vmem_limit_bytes",
+    [
+        (None, None, None),  # the kernel's tuned defaults
+        (8, 32, 64 * 1024 * 1024),  # overridden through the env vars
+    ])
+@patch(
+    "vllm.v1.attention.backends.pallas."
+    "_ragged_paged_attention_supports_kv_scales",
+    return_value=True)
+def test_ragged_paged_attention(_, kv_cache_dtype: str,
+                                use_kv_cache_update_kernel: bool,
+                                num_kv_pages_per_block: Optional[int],
+                                num_queries_per_block: Optional[int],
+                                vmem_limit_bytes: Optional[int],
+                                monkeypatch: pytest.MonkeyPatch):
     # We verify that the kernel inputs such as sliding_window, etc. are passed
-    # in from the model correctly.
+    # in from the model correctly, and that the KV cache is written.
     # The correctness of the paged attention kernel is tested in the kernel
-    # library.
+    # library. Off TPU, the KV cache update op runs its reference fallback.
+    monkeypatch.setenv("VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL",
+                       str(int(use_kv_cache_update_kernel)))
+    for name, env_value in (
+        ("VLLM_PALLAS_KV_PAGES_PER_BLOCK", num_kv_pages_per_block),
+        ("VLLM_PALLAS_Q_PER_BLOCK", num_queries_per_block),
+        ("VLLM_PALLAS_VMEM_BYTES", vmem_limit_bytes),
+    ):
+        if env_value is None:
+            monkeypatch.delenv(name, raising=False)
+        else:
+            monkeypatch.setenv(name, str(env_value))
     num_heads = 4
     head_size = 128
     scale = 1.0
@@ -27,15 +97,11 @@ def test_ragged_paged_attention():
         num_kv_heads=num_kv_heads,
         alibi_slopes=None,
         sliding_window=sliding_window,
-        kv_cache_dtype="auto",
+        kv_cache_dtype=kv_cache_dtype,
         logits_soft_cap=logits_soft_cap,
         attn_type=AttentionType.DECODER,
     )
 
-    class FakeAttentionLayer:
-        _k_scale_float: float
-        _v_scale_float: float
-
     layer = FakeAttentionLayer()
     layer._k_scale_float = 1.0
     layer._v_scale_float = 1.0
@@ -43,29 +109,17 @@ def test_ragged_paged_attention():
     num_tokens = 16
     num_blocks = 1024
     block_size = 16
-    query = torch.zeros(num_tokens, num_heads * head_size)
-    key = torch.zeros(num_tokens, num_kv_heads * head_size)
-    value = torch.zeros(num_tokens, num_kv_heads * head_size)
-    kv_cache = torch.zeros(num_blocks, block_size, num_kv_heads * 2, head_size)
-    slot_mapping = torch.zeros(num_tokens, dtype=torch.int64)
-    max_num_reqs = 8
-    max_num_blocks_per_req = 8
-    block_tables = torch.zeros((max_num_reqs, max_num_blocks_per_req),
-                               dtype=torch.int32)
-    context_lens = torch.ones((max_num_reqs, ), dtype=torch.int32)
-    query_lens = [1] * max_num_reqs
-    query_start_loc = torch.cumsum(torch.tensor([0] + query_lens,
-                                                dtype=torch.int32),
-                                   dim=0,
-                                   dtype=torch.int32)
-    num_seqs = torch.tensor([max_num_reqs], dtype=torch.int32)
-    attn_metadata = PallasMetadata(
-        slot_mapping=slot_mapping,
-        block_tables=block_tables,
-        context_lens=context_lens,
-        query_start_loc=query_start_loc,
-        num_seqs=num_seqs,
-    )
+    torch.manual_seed(0)
+    query = torch.randn(num_tokens, num_heads * head_size)
+    key = torch.randn(num_tokens, num_kv_heads * head_size)
+    value = torch.randn(num_tokens, num_kv_heads * head_size)
+    cache_dtype = attn_impl.kv_cache_quantized_dtype or torch.float32
+    kv_cache = torch.zeros(num_blocks,
+                           block_size,
+                           num_kv_heads * 2,
+                           head_size,
+                           dtype=cache_dtype)
+    attn_metadata = make_attn_metadata(num_tokens)
 
     with patch("torch.ops.xla.ragged_paged_attention"
                ) as mock_ragged_paged_attention:
@@ -78,6 +132,9 @@ def test_ragged_paged_attention():
             attn_metadata=attn_metadata,
         )
 
+        quant_kwargs = {}
+        if attn_impl.kv_cache_quantized_dtype is not None:
+            quant_kwargs = dict(k_scale=1.0, v_scale=1.0)
         mock_ragged_paged_attention.assert_called_once_with(
             ANY,  # query
             ANY,  # kv_cache
@@ -85,11 +142,209 @@ def test_ragged_paged_attention():
             ANY,  # block_tables
             ANY,  # query_start_loc
             ANY,  # num_seqs
-            num_kv_pages_per_block=None,
-            num_queries_per_block=None,
-            vmem_limit_bytes=None,
+            num_kv_pages_per_block=num_kv_pages_per_block,
+            num_queries_per_block=num_queries_per_block,
+            vmem_limit_bytes=vmem_limit_bytes,
             use_kernel=True,
             sm_scale=scale,
             sliding_window=sliding_window,
             soft_cap=logits_soft_cap,
+            **quant_kwargs,
+        )
+
+    assert_kv_cache_written(
+        kv_cache,
+        key.reshape(num_tokens, num_kv_heads, head_size).to(cache_dtype),
+        value.reshape(num_tokens, num_kv_heads, head_size).to(cache_dtype),
+        attn_metadata.slot_mapping)
+
+
+@pytest.mark.parametrize("use_kv_cache_update_kernel", [False, True])
+@patch(
+    "vllm.v1.attention.backends.pallas."
+    "_ragged_paged_attention_supports_kv_scales",
+    return_value=True)
+def test_ragged_paged_attention_fp8_kv_cache_scales(
+        _, use_kv_cache_update_kernel: bool, monkeypatch: pytest.MonkeyPatch):
+    # We verify that key and value are quantized with the layer's k/v scales
+    # before they are written, and that the same scales reach the kernel.
+    monkeypatch.setenv("VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL",
+                       str(int(use_kv_cache_update_kernel)))
+    num_heads = 4
+    head_size = 128
+    num_kv_heads = 4
+    k_scale = 2.0
+    v_scale = 4.0
+    attn_impl = PallasAttentionBackendImpl(
+        num_heads=num_heads,
+        head_size=head_size,
+        scale=1.0,
+        num_kv_heads=num_kv_heads,
+        alibi_slopes=None,
+        sliding_window=None,
+        kv_cache_dtype="fp8",
+        attn_type=AttentionType.DECODER,
+    )
+    quantized_dtype = attn_impl.kv_cache_quantized_dtype
+    assert quantized_dtype == torch.float8_e4m3fn
+
+    layer = FakeAttentionLayer()
+    layer._k_scale_float = k_scale
+    layer._v_scale_float = v_scale
+
+    num_tokens = 16
+    num_blocks = 1024
+    block_size = 16
+    torch.manual_seed(0)
+    query = torch.randn(num_tokens, num_heads * head_size)
+    # Large enough for some values to be clamped to the float8 range.
+    key = torch.randn(num_tokens, num_kv_heads * head_size) * 1000
+    value = torch.randn(num_tokens, num_kv_heads * head_size) * 1000
+    kv_cache = torch.zeros(num_blocks,
+                           block_size,
+                           num_kv_heads * 2,
+                           head_size,
+                           dtype=quantized_dtype)
+    attn_metadata = make_attn_metadata(num_tokens)
+
+    with patch("torch.ops.xla.ragged_paged_attention"
+               ) as mock_ragged_paged_attention:
+        attn_impl.forward(
+            layer=layer,
+            query=query,
+            key=key,
+            value=value,
+            kv_cache=kv_cache,
+            attn_metadata=attn_metadata,
+        )
+
+        mock_ragged_paged_attention.assert_called_once()
+        kwargs = mock_ragged_paged_attention.call_args.kwargs
+        assert kwargs["k_scale"] == k_scale
+        assert kwargs["v_scale"] == v_scale
+
+    dtype_info = torch.finfo(quantized_dtype)
+
+    def quantize(x: torch.Tensor, scale: float) -> torch.Tensor:
+        x = x.reshape(num_tokens, num_kv_heads, head_size) / scale
+        return torch.clamp(x, dtype_info.min,
+                           dtype_info.max).to(quantized_dtype)
+
+    assert_kv_cache_written(kv_cache, quantize(key, k_scale),
+                            quantize(value, v_scale),
+                            attn_metadata.slot_mapping)
+
+
+@pytest.mark.parametrize("head_size", [64, 80])
+def test_ragged_paged_attention_padded_head_size(head_size: int):
+    # We verify that a head size which is not a multiple of 128 is padded
+    # before the KV cache write and the kernel, and sliced back afterwards.
+    num_heads = 4
+    num_kv_heads = 4
+    attn_impl = PallasAttentionBackendImpl(
+        num_heads=num_heads,
+        head_size=head_size,
+        scale=1.0,
+        num_kv_heads=num_kv_heads,
+        alibi_slopes=None,
+        sliding_window=None,
+        kv_cache_dtype="auto",
+        attn_type=AttentionType.DECODER,
+    )
+    assert attn_impl.forward == attn_impl._forward_padded
+
+    layer = FakeAttentionLayer()
+    layer._k_scale_float = 1.0
+    layer._v_scale_float = 1.0
+
+    num_tokens = 16
+    padded_head_size = 128
+    torch.manual_seed(0)
+    query = torch.randn(num_tokens, num_heads * head_size)
+    key = torch.randn(num_tokens, num_kv_heads * head_size)
+    value = torch.randn(num_tokens, num_kv_heads * head_size)
+    kv_cache_shape = PallasAttentionBackend.get_kv_cache_shape(
+        num_blocks=1024,
+        block_size=16,
+        num_kv_heads=num_kv_heads,
+        head_size=head_size)
+    assert kv_cache_shape[-1] == padded_head_size
+    kv_cache = torch.zeros(kv_cache_shape)
+    attn_metadata = make_attn_metadata(num_tokens)
+
+    def pad(x: torch.Tensor, num_heads: int) -> torch.Tensor:
+        return torch.nn.functional.pad(
+            x.reshape(num_tokens, num_heads, head_size),
+            (0, padded_head_size - head_size))
+
+    # The mocked kernel returns the query, so the output must be the
+    # unpadded query again.
+    with patch("torch.ops.xla.ragged_paged_attention",
+               side_effect=lambda query, *args, **kwargs: query
+               ) as mock_ragged_paged_attention:
+        output = attn_impl.forward(
+            layer=layer,
+            query=query,
+            key=key,
+            value=value,
+            kv_cache=kv_cache,
+            attn_metadata=attn_metadata,
+        )
+
+        mock_ragged_paged_attention.assert_called_once()
+        kernel_query = mock_ragged_paged_attention.call_args.args[0]
+        assert kernel_query.shape == (num_tokens, num_heads, padded_head_size)
+        torch.testing.assert_close(kernel_query, pad(query, num_heads))
+
+    assert output.shape == (num_tokens, num_heads * head_size)
+    torch.testing.assert_close(output, query)
+    assert_kv_cache_written(kv_cache, pad(key, num_kv_heads),
+                            pad(value, num_kv_heads),
+                            attn_metadata.slot_mapping)
+
+
+def test_ragged_paged_attention_kv_scales_schema():
+    # Not patched: checks the registered kernel of the installed torch_xla.
+    # If this fails, the pinned torch_xla cannot serve an fp8 KV cache.
+    assert _ragged_paged_attention_supports_kv_scales()
+
+
+@pytest.mark.parametrize("kv_cache_dtype", ["fp8", "fp8_e5m2"])
+@patch(
+    "vllm.v1.attention.backends.pallas."
+    "_ragged_paged_attention_supports_kv_scales",
+    return_value=False)
+def test_fp8_kv_cache_rejected_without_kv_scales(_, kv_cache_dtype: str):
+    with pytest.raises(NotImplementedError, match="k_scale and v_scale"):
+        PallasAttentionBackendImpl(
+            num_heads=4,
+            head_size=128,
+            scale=1.0,
+            num_kv_heads=4,
+            alibi_slopes=None,
+            sliding_window=None,
+            kv_cache_dtype=kv_cache_dtype,
+            attn_type=AttentionType.DECODER,
         )
+
+
+@pytest.mark.parametrize("page_size", [16, 128, 512])
+def test_page_size_env_override(monkeypatch: pytest.MonkeyPatch,
+                                page_size: int):
+    monkeypatch.setenv("VLLM_PALLAS_PAGE_SIZE", str(page_size))
+    # The override takes precedence over the max_model_len heuristic.
+    assert PallasAttentionBackend.get_page_size(MagicMock()) == page_size
+
+
+@pytest.mark.parametrize(
+    "page_size",
+    [
+        8,  # below the range
+        1024,  # above the range
+        48,  # not a power of two
+    ])
+def test_page_size_env_override_invalid(monkeypatch: pytest.MonkeyPatch,
+                                        page_size: int):
+    monkeypatch.setenv("VLLM_PALLAS_PAGE_SIZE", str(page_size))
+    with pytest.raises(ValueError, match="VLLM_PALLAS_PAGE_SIZE"):
+        PallasAttentionBackend.get_page_size(MagicMock())
@@ -0,0 +1,115 @@
+# SPDX-License-Identifier: Apache-2.0
+# SPDX-FileCopyrightText: Copyright contributors to the vLLM project
+
+import functools
+
+import jax
+import jax.numpy as jnp
+from jax.experimental import pallas as pl
+from jax.experimental.pallas import tpu as pltpu
+
+from vllm.utils import cdiv
+
+
+def _kv_cache_update_kernel(
+    # Prefetch
+    slot_mapping_ref,  # [padded_num_tokens]
+    # Input
+    key_ref,  # [num_tokens_per_block, num_kv_heads, head_size]
+    value_ref,  # [num_tokens_per_block, num_kv_heads, head_size]
+    kv_cache_hbm_ref,  # [num_pages, page_size, num_kv_heads * 2, head_size]
+    # Output
+    _,  # aliased with kv_cache_hbm_ref
+    # Scratch
+    kv_scratch,  # [num_tokens_per_block, num_kv_heads * 2, head_size]
+    sem,
+):
+    block_idx = pl.program_id(0)
+    num_tokens_per_block, num_kv_heads, _ = key_ref.shape
+    num_pages, page_size = kv_cache_hbm_ref.shape[:2]
+    num_slots = num_pages * page_size
+
+    # Interleave the key and value tiles in VMEM, since the combined kv heads
+    # of the cache are laid out as [k0, v0, k1, v1, ...]. This way each token
+    # is written with a single DMA and no kv tensor is staged in HBM.
+    kv_scratch[:, pl.ds(0, num_kv_heads, stride=2), :] = key_ref[...]
+    kv_scratch[:, pl.ds(1, num_kv_heads, stride=2), :] = value_ref[...]
+
+    token_copies = []
+    for i in range(num_tokens_per_block):
+        slot = slot_mapping_ref[block_idx * num_tokens_per_block + i]
+        copy = pltpu.make_async_copy(
+            kv_scratch.at[i],
+            kv_cache_hbm_ref.at[slot // page_size, slot % page_size],
+            sem,
+        )
+        # Padded tokens point to an out-of-range slot and are skipped.
+        token_copies.append((slot < num_slots, copy))
+
+    for is_valid, copy in token_copies:
+
+        @pl.when(is_valid)
+        def _start(copy=copy):
+            copy.start()
+
+    for is_valid, copy in token_copies:
+
+        @pl.when(is_valid)
+        def _wait(copy=copy):
+            copy.wait()
+
+
+@functools.partial(jax.jit, static_argnames=["num_tokens_per_block"])
+def kv_cache_update(
+    key: jax.Array,  # [num_tokens, num_kv_heads, head_size]
+    value: jax.Array,  # [num_tokens, num_kv_heads, head_size]
+    slot_mapping: jax.Array,  # [num_tokens]
+    # [num_pages, page_size, num_kv_heads * 2, head_size]
+    kv_cache: jax.Array,
+    *,
+    num_tokens_per_block: int = 16,
+) -> jax.Array:
+    num_tokens, num_kv_heads, head_size = key.shape
+    num_pages, page_size, num_combined_kv_heads, _ = kv_cache.shape
+    num_slots = num_pages * page_size
+    assert value.shape == key.shape
+    assert key.dtype == value.dtype == kv_cache.dtype
+    assert num_combined_kv_heads == 2 * num_kv_heads
+    assert kv_cache.shape[3] == head_size
+    assert head_size % 128 == 0
+
+    num_blocks = cdiv(num_tokens, num_tokens_per_block)
+    # Any slot id >= num_slots is ignored by the kernel, which matches the
+    # out-of-bound behavior of the index_copy_ based write. This also covers
+    # the tokens of a partial last block.
+    slot_mapping = jnp.pad(slot_mapping.astype(jnp.int32),
+                           (0, num_blocks * num_tokens_per_block - num_tokens),
+                           constant_values=num_slots)
+
+    kv_block_spec = pl.BlockSpec(
+        (num_tokens_per_block, num_kv_heads, head_size),
+        lambda i, *_: (i, 0, 0),
+    )
+    kernel = pl.pallas_call(
+        _kv_cache_update_kernel,
+        grid_spec=pltpu.PrefetchScalarGridSpec(
+            num_scalar_prefetch=1,
+            in_specs=[
+                kv_block_spec,
+                kv_block_spec,
+                pl.BlockSpec(memory_space=pltpu.TPUMemorySpace.ANY),
+            ],
+            out_specs=pl.BlockSpec(memory_space=pltpu.TPUMemorySpace.ANY),
+            grid=(num_blocks, ),
+            scratch_shapes=[
+                pltpu.VMEM(
+                    (num_tokens_per_block, num_combined_kv_heads, head_size),
+                    kv_cache.dtype),
+                pltpu.SemaphoreType.DMA,
+            ],
+        ),
+        out_shape=jax.ShapeDtypeStruct(kv_cache.shape, kv_cache.dtype),
+        # kv_cache is updated in place.
+        input_output_aliases={3: 0},
+    )
+    return kernel(slot_mapping, key, value, kv_cache)
@@ -118,6 +118,11 @@ if TYPE_CHECKING:
     VLLM_MARLIN_USE_ATOMIC_ADD: bool = False
     VLLM_V0_USE_OUTLINES_CACHE: bool = False
     VLLM_TPU_BUCKET_PADDING_GAP: int = 0
+    VLLM_PALLAS_KV_PAGES_PER_BLOCK: Optional[int] = None
+    VLLM_PALLAS_Q_PER_BLOCK: Optional[int] = None
+    VLLM_PALLAS_VMEM_BYTES: Optional[int] = None
+    VLLM_PALLAS_PAGE_SIZE: Optional[int] = None
+    VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL: bool = False
     VLLM_USE_DEEP_GEMM: bool = False
     VLLM_XGRAMMAR_CACHE_MB: int = 0
     VLLM_MSGPACK_ZERO_COPY_THRESHOLD: int = 256
@@ -825,6 +830,28 @@ environment_variables: dict[str, Callable[[], Any]] = {
     lambda: int(os.environ["VLLM_TPU_BUCKET_PADDING_GAP"])
     if "VLLM_TPU_BUCKET_PADDING_GAP" in os.environ else 0,
 
+    # Override the block sizes and the VMEM limit of the ragged paged
+    # attention Pallas kernel. By default the kernel picks its own tuned
+    # values for the given shapes.
+    "VLLM_PALLAS_KV_PAGES_PER_BLOCK":
+    lambda: maybe_convert_int(
+        os.environ.get("VLLM_PALLAS_KV_PAGES_PER_BLOCK", None)),
+    "VLLM_PALLAS_Q_PER_BLOCK":
+    lambda: maybe_convert_int(os.environ.get("VLLM_PALLAS_Q_PER_BLOCK", None)),
+    "VLLM_PALLAS_VMEM_BYTES":
+    lambda: maybe_convert_int(os.environ.get("VLLM_PALLAS_VMEM_BYTES", None)),
+
+    # Override the KV cache page size chosen by the Pallas attention backend
+    # on TPU, e.g. with the best value found by benchmarking a given model.
+    # Must be a power of two in [16, 512].
+    "VLLM_PALLAS_PAGE_SIZE":
+    lambda: maybe_convert_int(os.environ.get("VLLM_PALLAS_PAGE_SIZE", None)),
+
+    # If set, the Pallas attention backend on TPU writes the KV cache with the
+    # kv_cache_update Pallas kernel instead of the index_copy_ scatter.
+    "VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL":
+    lambda: bool(int(os.getenv("VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL", "0"))),
+
     # Allow use of DeepGemm kernels for fused moe ops.
     "VLLM_USE_DEEP_GEMM":
     lambda: bool(int(os.getenv("VLLM_USE_DEEP_GEMM", "0"))),
@@ -968,6 +995,11 @@ def compute_hash() -> str:
         "VLLM_DP_RANK",
         "VLLM_DP_SIZE",
         "VLLM_USE_STANDALONE_COMPILE",
+        "VLLM_PALLAS_KV_PAGES_PER_BLOCK",
+        "VLLM_PALLAS_Q_PER_BLOCK",
+        "VLLM_PALLAS_VMEM_BYTES",
+        "VLLM_PALLAS_PAGE_SIZE",
+        "VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL",
     ]
     for key in environment_variables_to_hash:
         if key in environment_variables:
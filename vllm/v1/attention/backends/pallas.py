@@ -1,13 +1,18 @@
 # SPDX-License-Identifier: Apache-2.0
 # SPDX-FileCopyrightText: Copyright contributors to the vLLM project
 
+import functools
 from dataclasses import dataclass
 from typing import Any, Optional
 
 import torch
+import torch_xla.core.xla_builder as xb
 # Required to register custom ops.
 import torch_xla.experimental.custom_kernel  # noqa: F401
+from torch.library import impl
+from torch_xla.experimental.custom_kernel import XLA_LIB, jax_import_guard
 
+import vllm.envs as envs
 from vllm.attention.backends.abstract import (AttentionBackend, AttentionImpl,
                                               AttentionLayer, AttentionType)
 from vllm.attention.backends.utils import CommonAttentionState
@@ -19,6 +24,34 @@ logger = init_logger(__name__)
 
 # TPU requires the head size to be a multiple of 128.
 TPU_HEAD_SIZE_ALIGNMENT = 128
+# Number of int32 entries that fit in half of the 1MB TPU SMEM.
+TPU_SMEM_HALF_BYTES_PER_INT = 131072
+# Unlike STR_DTYPE_TO_TORCH_DTYPE, the fp8 KV cache dtypes are stored as real
+# float8 types on TPU, since the values are cast when written to the cache.
+TPU_STR_DTYPE_TO_TORCH_DTYPE = {
+    "half": torch.half,
+    "bfloat16": torch.bfloat16,
+    "float": torch.float,
+    "fp8": torch.float8_e4m3fn,
+    "fp8_e4m3": torch.float8_e4m3fn,
+    "fp8_e5m2": torch.float8_e5m2,
+}
+
+
+# The TPU version is fixed for the process, while PallasAttentionBackendImpl is
+# constructed for every attention layer of the model.
+@functools.cache
+def _get_tpu_version() -> int:
+    return torch_xla.tpu.version()
+
+
+# The fp8 KV cache relies on ragged_paged_attention dequantizing the pages with
+# k_scale/v_scale, which older torch_xla builds do not accept.
+@functools.cache
+def _ragged_paged_attention_supports_kv_scales() -> bool:
+    schema = torch.ops.xla.ragged_paged_attention.default._schema
+    arg_names = {arg.name for arg in schema.arguments}
+    return {"k_scale", "v_scale"} <= arg_names
 
 
 class PallasAttentionBackend(AttentionBackend):
@@ -54,6 +87,10 @@ class PallasAttentionBackend(AttentionBackend):
                 "head size is padded to %d, and num_blocks is adjusted to %d"
                 " accordingly", padded_head_size, num_blocks)
         head_size = padded_head_size
+        # NOTE: This layout, with the kv heads interleaved as
+        # [k0, v0, k1, v1, ...], is the page layout expected by the
+        # ragged_paged_attention kernel of torch_xla. It cannot be changed
+        # here independently of that kernel.
         return (num_blocks, block_size, num_kv_heads * 2, head_size)
 
     @staticmethod
@@ -70,19 +107,28 @@ class PallasAttentionBackend(AttentionBackend):
     # we simply make sure that the size is smaller than half of SMEM capacity.
     @staticmethod
     def get_min_page_size(vllm_config: VllmConfig) -> int:
-        max_num_page_per_req = (1024 * 1024 // 2 //
-                                vllm_config.scheduler_config.max_num_seqs // 4)
+        max_num_page_per_req = (TPU_SMEM_HALF_BYTES_PER_INT //
+                                vllm_config.scheduler_config.max_num_seqs)
         min_page_size = cdiv(vllm_config.model_config.max_model_len,
                              max_num_page_per_req)
-        min_page_size = 1 << (min_page_size - 1).bit_length()
-        return min_page_size
+        return next_power_of_2(min_page_size)
 
     # TPU has limited SREGs (scalar registers), if page_size is too small, we
     # can spill SREGs easily which leads to bad performance. The strategy we
     # apply here is trying to split max-model-len to 16 pages which make the
     # spill less likely. Meanwhile we make sure the page size is in [16, 256].
+    # The best page size depends on the model and workload though, so it can
+    # be overridden with VLLM_PALLAS_PAGE_SIZE after benchmarking.
     @staticmethod
     def get_page_size(vllm_config: VllmConfig) -> int:
+        if envs.VLLM_PALLAS_PAGE_SIZE is not None:
+            page_size = envs.VLLM_PALLAS_PAGE_SIZE
+            if not (16 <= page_size <= 512
+                    and page_size == next_power_of_2(page_size)):
+                raise ValueError(
+                    "VLLM_PALLAS_PAGE_SIZE must be a power of two in "
+                    f"[16, 512], got {page_size}.")
+            return page_size
         page_size = next_power_of_2(
             vllm_config.model_config.max_model_len) // 16
         if page_size <= 16:
@@ -141,12 +187,35 @@ class PallasAttentionBackendImpl(AttentionImpl):
         self.sliding_window = sliding_window
         self.logits_soft_cap = logits_soft_cap
         self.kv_sharing_target_layer_name = kv_sharing_target_layer_name
+        # Computed once here since forward runs for every layer at every step.
+        self._padded_head_size = cdiv(
+            head_size, TPU_HEAD_SIZE_ALIGNMENT) * TPU_HEAD_SIZE_ALIGNMENT
+        self._needs_pad = head_size % TPU_HEAD_SIZE_ALIGNMENT != 0
+        self._pad_amt = self._padded_head_size - head_size
+        # By default, the kernel utilizes optimized block size and
+        # vmem_limit_bytes parameters from the kernel repository. However,
+        # these can be manually adjusted for tuning or debugging if necessary.
+        self.num_kv_pages_per_block = envs.VLLM_PALLAS_KV_PAGES_PER_BLOCK
+        self.num_queries_per_block = envs.VLLM_PALLAS_Q_PER_BLOCK
+        self.vmem_limit_bytes = envs.VLLM_PALLAS_VMEM_BYTES
+        self.use_kv_cache_update_kernel = (
+            envs.VLLM_PALLAS_USE_KV_CACHE_UPDATE_KERNEL)
 
-        self.num_queries_per_kv = self.num_heads // self.num_kv_heads
         if alibi_slopes is not None:
             raise NotImplementedError("Alibi slopes is not supported.")
+        self.kv_cache_quantized_dtype: Optional[torch.dtype] = None
         if kv_cache_dtype != "auto":
-            raise NotImplementedError("FP8 KV cache dtype is not supported.")
+            self.kv_cache_quantized_dtype = TPU_STR_DTYPE_TO_TORCH_DTYPE.get(
+                kv_cache_dtype.lower().strip())
+            if self.kv_cache_quantized_dtype not in (torch.float8_e4m3fn,
+                                                     torch.float8_e5m2):
+                raise NotImplementedError(
+                    f"{kv_cache_dtype} KV cache dtype is not supported.")
+            if not _ragged_paged_attention_supports_kv_scales():
+                raise NotImplementedError(
+                    f"{kv_cache_dtype} KV cache dtype requires a torch_xla "
+                    "version whose ragged_paged_attention takes k_scale and "
+                    "v_scale.")
         if blocksparse_params is not None:
             raise NotImplementedError("Blocksparse is not supported.")
 
@@ -156,10 +225,15 @@ class PallasAttentionBackendImpl(AttentionImpl):
                                       "are not implemented for "
                                       "PallasAttentionBackendImpl")
 
-        tpu_version = torch_xla.tpu.version()
-        if tpu_version < 4:
+        if _get_tpu_version() < 4:
             raise NotImplementedError("TPU version must be 4 or higher.")
 
+        # Specialize forward once so that the common aligned case does not
+        # carry any of the padding logic.
+        self.forward = (  # type: ignore[method-assign]
+            self._forward_padded
+            if self._needs_pad else self._forward_aligned)
+
     def forward(
         self,
         layer: AttentionLayer,
@@ -173,6 +247,10 @@ class PallasAttentionBackendImpl(AttentionImpl):
     ) -> torch.Tensor:
         """Forward pass with Pallas attention.
 
+        NOTE: __init__ rebinds `forward` on each instance to the
+        specialization matching its head size, so this dispatch only runs
+        when the method is called through the class.
+
         Args:
             query: shape = [num_tokens, num_heads * head_size]
             key: shape = [num_tokens, num_kv_heads * head_size]
@@ -182,62 +260,154 @@ class PallasAttentionBackendImpl(AttentionImpl):
         Returns:
             shape = [num_tokens, num_heads * head_size]
         """
+        if self._needs_pad:
+            return self._forward_padded(layer, query, key, value, kv_cache,
+                                        attn_metadata, output, output_scale)
+        return self._forward_aligned(layer, query, key, value, kv_cache,
+                                     attn_metadata, output, output_scale)
+
+    def _forward_aligned(
+        self,
+        layer: AttentionLayer,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        kv_cache: torch.Tensor,
+        attn_metadata: PallasMetadata,
+        output: Optional[torch.Tensor] = None,
+        output_scale: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Forward pass for inputs whose head size is already aligned."""
         if output_scale is not None:
             raise NotImplementedError(
                 "fused output quantization is not yet supported"
                 " for PallasAttentionBackendImpl")
 
-        # For determine_available_memory case.
         if kv_cache.numel() == 0:
-            if output is None:
-                output = torch.ones_like(query)
-            return output
+            return self._forward_probe(query, output)
 
-        assert layer._k_scale_float == 1.0 and layer._v_scale_float == 1.0
         num_tokens, hidden_size = query.shape
-        query = query.view(num_tokens, self.num_heads, self.head_size)
-        key = key.view(-1, self.num_kv_heads, self.head_size)
-        value = value.view(-1, self.num_kv_heads, self.head_size)
-        if self.head_size % TPU_HEAD_SIZE_ALIGNMENT != 0:
-            padded_head_size = cdiv(
-                self.head_size,
-                TPU_HEAD_SIZE_ALIGNMENT) * TPU_HEAD_SIZE_ALIGNMENT
-            query = torch.nn.functional.pad(
-                query, (0, padded_head_size - self.head_size), value=0.0)
-            key = torch.nn.functional.pad(
-                key, (0, padded_head_size - self.head_size), value=0.0)
-            value = torch.nn.functional.pad(
-                value, (0, padded_head_size - self.head_size), value=0.0)
-
-        if self.kv_sharing_target_layer_name is None and kv_cache.numel() > 0:
+        # NOTE: reshape instead of view, since the inputs may be strided
+        # slices of a fused QKV projection output. It is still a free view
+        # whenever the strides allow it.
+        query = query.reshape(num_tokens, self.num_heads, self.head_size)
+        key = key.reshape(-1, self.num_kv_heads, self.head_size)
+        value = value.reshape(-1, self.num_kv_heads, self.head_size)
+
+        output = self._attention(layer, query, key, value, kv_cache,
+                                 attn_metadata)
+        return output.reshape(num_tokens, hidden_size)
+
+    def _forward_padded(
+        self,
+        layer: AttentionLayer,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        kv_cache: torch.Tensor,
+        attn_metadata: PallasMetadata,
+        output: Optional[torch.Tensor] = None,
+        output_scale: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Forward pass padding the head size to TPU_HEAD_SIZE_ALIGNMENT."""
+        if output_scale is not None:
+            raise NotImplementedError(
+                "fused output quantization is not yet supported"
+                " for PallasAttentionBackendImpl")
+
+        if kv_cache.numel() == 0:
+            return self._forward_probe(query, output)
+
+        num_tokens, hidden_size = query.shape
+        query = torch.nn.functional.pad(
+            query.reshape(num_tokens, self.num_heads, self.head_size),
+            (0, self._pad_amt),
+            value=0.0)
+        key = torch.nn.functional.pad(
+            key.reshape(-1, self.num_kv_heads, self.head_size),
+            (0, self._pad_amt),
+            value=0.0)
+        value = torch.nn.functional.pad(
+            value.reshape(-1, self.num_kv_heads, self.head_size),
+            (0, self._pad_amt),
+            value=0.0)
+
+        output = self._attention(layer, query, key, value, kv_cache,
+                                 attn_metadata)
+        return output[:, :, :self.head_size].reshape(num_tokens, hidden_size)
+
+    def _attention(
+        self,
+        layer: AttentionLayer,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        kv_cache: torch.Tensor,
+        attn_metadata: PallasMetadata,
+    ) -> torch.Tensor:
+        """Write the KV cache and run the ragged paged attention kernel.
+
+        Args:
+            query: shape = [num_tokens, num_heads, padded_head_size]
+            key: shape = [num_tokens, num_kv_heads, padded_head_size]
+            value: shape = [num_tokens, num_kv_heads, padded_head_size]
+        Returns:
+            shape = [num_tokens, num_heads, padded_head_size]
+        """
+        # NOTE: The k/v scales are only used with a quantized KV cache. For the
+        # "auto" kv_cache_dtype they are pinned to 1.0 after weight loading
+        # (see BaseKVCacheMethod), so they are not re-checked at every step.
+        k_scale = layer._k_scale_float
+        v_scale = layer._v_scale_float
+
+        if self.kv_sharing_target_layer_name is None:
             # Write input keys and values to the KV cache.
             # Skip this if sharing KV cache with an earlier attention layer.
+            # NOTE: The current tokens' KV is read back from HBM by
+            # ragged_paged_attention right after this write. Folding the write
+            # into the kernel prologue would avoid that, but torch_xla has no
+            # variant taking the new keys/values and slot_mapping.
             slot_mapping = attn_metadata.slot_mapping
-            write_to_kv_cache(key, value, kv_cache, slot_mapping)
+            write_to_kv_cache(key, value, kv_cache, slot_mapping,
+                              self.kv_cache_quantized_dtype, k_scale, v_scale,
+                              self.use_kv_cache_update_kernel)
+
+        # The kernel dequantizes the KV cache with the per-tensor scales.
+        quant_kwargs = {}
+        if self.kv_cache_quantized_dtype is not None:
+            quant_kwargs = dict(k_scale=k_scale, v_scale=v_scale)
 
-        output = torch.ops.xla.ragged_paged_attention(
+        return torch.ops.xla.ragged_paged_attention(
             query,
             kv_cache,
             attn_metadata.context_lens,
             attn_metadata.block_tables,
             attn_metadata.query_start_loc,
             attn_metadata.num_seqs,
-            # By default, the system utilizes optimized block size and
-            # vmem_limit_bytes parameters from the kernel repository. However,
-            # these can be manually adjusted for debugging if necessary.
-            num_kv_pages_per_block=None,
-            num_queries_per_block=None,
-            vmem_limit_bytes=None,
+            num_kv_pages_per_block=self.num_kv_pages_per_block,
+            num_queries_per_block=self.num_queries_per_block,
+            vmem_limit_bytes=self.vmem_limit_bytes,
             use_kernel=True,
             sm_scale=self.scale,
             sliding_window=self.sliding_window,
             soft_cap=self.logits_soft_cap,
+            **quant_kwargs,
         )
 
-        if self.head_size % TPU_HEAD_SIZE_ALIGNMENT != 0:
-            output = output[:, :, :self.head_size]
+    def _forward_probe(
+        self,
+        query: torch.Tensor,
+        output: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Forward pass for the determine_available_memory case.
 
-        return output.reshape(num_tokens, hidden_size)
+        The profiling run has no KV cache yet. It is traced into its own
+        graph, as the worker resets the dynamo cache before the model runs
+        with the real KV cache, so this never reaches the serving graph.
+        """
+        if output is None:
+            output = torch.ones_like(query)
+        return output
 
 
 def write_to_kv_cache(
@@ -245,22 +415,77 @@ def write_to_kv_cache(
     value: torch.Tensor,
     kv_cache: torch.Tensor,
     slot_mapping: torch.Tensor,
+    kv_cache_quantized_dtype: Optional[torch.dtype] = None,
+    k_scale: float = 1.0,
+    v_scale: float = 1.0,
+    use_kv_cache_update_kernel: bool = False,
 ) -> None:
     """ Write the key and values to the KV cache.
 
     Args:
-        key: shape = [num_tokens, num_kv_heads * head_size]
-        value: shape = [num_tokens, num_kv_heads *  head_size]
+        key: shape = [num_tokens, num_kv_heads, head_size]
+        value: shape = [num_tokens, num_kv_heads, head_size]
         kv_cache = [num_blocks, block_size, num_kv_heads * 2, head_size]
+        kv_cache_quantized_dtype: If set, key and value are quantized to this
+            dtype with the per-tensor k_scale and v_scale before the write.
+        use_kv_cache_update_kernel: If set, write with the Pallas kernel
+            instead of index_copy_.
 
     """
+    if kv_cache_quantized_dtype is not None:
+        dtype_info = torch.finfo(kv_cache_quantized_dtype)
+        key = key.to(torch.float32) / k_scale
+        key = torch.clamp(key, dtype_info.min, dtype_info.max)
+        key = key.to(kv_cache_quantized_dtype)
+        value = value.to(torch.float32) / v_scale
+        value = torch.clamp(value, dtype_info.min, dtype_info.max)
+        value = value.to(kv_cache_quantized_dtype)
+
+    # Only kv_cache needs to be donated: it is the sole graph input written
+    # here. key and value are intermediates of the traced graph whose buffers
+    # XLA already reuses, and both paths write them without a kv temporary.
+    torch.ops.xla.dynamo_set_buffer_donor_(kv_cache, True)
+
+    if use_kv_cache_update_kernel:
+        # The kernel resolves slots into (page, offset) itself, so the paged
+        # kv_cache is passed as is rather than through a flattened view.
+        new_kv_cache = torch.ops.xla.kv_cache_update(key, value,
+                                                     slot_mapping, kv_cache)
+        kv_cache.copy_(new_kv_cache)
+        return
+
+    # The combined kv heads are interleaved as [k0, v0, k1, v1, ...]. Write
+    # the keys and values directly into their halves instead of materializing
+    # the concatenated kv tensor first.
     _, _, num_combined_kv_heads, head_size = kv_cache.shape
-    head_size = cdiv(head_size,
-                     TPU_HEAD_SIZE_ALIGNMENT) * TPU_HEAD_SIZE_ALIGNMENT
-    kv = torch.cat([key, value], axis=-1).reshape(-1, num_combined_kv_heads,
-                                                  head_size)
+    kv_cache = kv_cache.flatten(0, 1).view(-1, num_combined_kv_heads // 2, 2,
+                                           head_size)
+    kv_cache[:, :, 0].index_copy_(0, slot_mapping, key)
+    kv_cache[:, :, 1].index_copy_(0, slot_mapping, value)
+
+
+XLA_LIB.define("kv_cache_update(Tensor key, Tensor value, "
+               "Tensor slot_mapping, Tensor kv_cache) -> Tensor")
 
-    torch.ops.xla.dynamo_set_buffer_donor_(kv_cache, True)
 
-    kv_cache = kv_cache.flatten(0, 1)
-    kv_cache.index_copy_(0, slot_mapping, kv)
+@impl(XLA_LIB, "kv_cache_update", "XLA")
+def kv_cache_update_xla(key: torch.Tensor, value: torch.Tensor,
+                        slot_mapping: torch.Tensor,
+                        kv_cache: torch.Tensor) -> torch.Tensor:
+    jax_import_guard()
+    from vllm.attention.ops.pallas_kv_cache_update import kv_cache_update
+    return xb.call_jax(kv_cache_update, (key, value, slot_mapping, kv_cache))
+
+
+@impl(XLA_LIB, "kv_cache_update", "CompositeExplicitAutograd")
+def kv_cache_update_non_xla(key: torch.Tensor, value: torch.Tensor,
+                            slot_mapping: torch.Tensor,
+                            kv_cache: torch.Tensor) -> torch.Tensor:
+    # Reference scatter with the same semantics as the kernel: the combined kv
+    # heads are interleaved, and slots past the end of the cache are skipped.
+    num_pages, page_size, num_combined_kv_heads, head_size = kv_cache.shape
+    kv = torch.stack([key, value], dim=2).reshape(-1, num_combined_kv_heads,
+                                                  head_size)
+    valid = slot_mapping < num_pages * page_size
+    return kv_cache.flatten(0, 1).index_copy(
+        0, slot_mapping[valid], kv[valid]).view(kv_cache.shape)